@@ -3,12 +3,16 @@
 bpm_extractor_combined.py
 
 Opção 3 — combinação:
+- tempo global barato (ativações do RNN) para restringir a faixa de BPM do DBN
+- roteamento (opcional): tempo estável (pulsos PLP + tempograma) -> bpm_map de um segmento, sem DBN
 - RNNBeatProcessor + DBNBeatTrackingProcessor (madmom) para beat_times estáveis
 - cálculo direto de BPM = 60 / diff(beat_times)
 - remoção de outliers robusta (MAD)
 - suavização Gaussiana preservando rampas
 - limitador de aceleração (max BPM change por segundo)
 - agregação em janelas (opcional) para UI
+- handoff de stems por buffers float32 mapeados em memória (separação -> worker de análise)
+- orçamento de threads de CPU por job (torch, BLAS/OpenMP, madmom) + relatório de throughput
 
 Rode: python bpm_extractor_combined.py
 """
@@ -16,15 +20,28 @@ Rode: python bpm_extractor_combined.py
 import os
 import json
 import time
+import uuid
+import shutil
+import tempfile
 import warnings
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import numpy as np
 import librosa
 
 import torch
 import demucs.separate
+from demucs.apply import apply_model
+from demucs.audio import AudioFile
+from demucs.pretrained import get_model
 
+from madmom.audio.signal import Signal
 from madmom.features.beats import RNNBeatProcessor, DBNBeatTrackingProcessor
+from madmom.features.beats_hmm import BeatStateSpace
+from madmom.features.tempo import TempoEstimationProcessor
+
+from threadpoolctl import threadpool_limits  # limita BLAS/OpenMP já carregados no processo
 
 
 # ----------------- CONFIG -----------------
@@ -38,8 +55,63 @@ MAD_Z_THRESH = 3.0           # remoção de outliers via MAD
 MAX_BPM_CHANGE_PER_SEC = 4.5 # limitar mudança de bpm (BPM por segundo). Ajuste conforme musica.
 AGG_WINDOW_SEC = 2.0         # agrupar resultados para UI. 0 = sem agregação
 MIN_BEATS = 3
+MADMOM_SR = 44100             # sample rate esperado pelo RNNBeatProcessor
+
+# handoff separação -> análise
+STEM_HANDOFF = "memmap"       # "memmap" = buffers float32 mapeados em memória | "wav" = arquivos em STEMS_FOLDER
+HANDOFF_DIR = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()  # /dev/shm = RAM no linux
+ANALYSIS_SOURCE = "mix"       # buffer analisado pelo worker: "mix" ou um stem ("drums", "other", ...)
+HANDOFF_STEMS = None          # stems publicados: None = todos os do modelo; ex: ("drums",) se só ele for lido
+                              # (o ANALYSIS_SOURCE é sempre publicado)
+SKIP_SEPARATION = False       # True = não roda o Demucs; só a mix é publicada (exige ANALYSIS_SOURCE = "mix")
+HANDOFF_HEADROOM = 0.1        # folga de espaço livre exigida além do tamanho dos buffers
+
+# orçamento de threads (evita oversubscription com vários jobs por nó)
+# cores que este processo pode usar (affinity/cpuset do container); cpu_count() devolve os do host
+NODE_CORES = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else (os.cpu_count() or 1)
+JOBS_PER_NODE = 1             # jobs (músicas) simultâneos no nó; escolha com o relatório de throughput
+THROUGHPUT_REPORT = False     # True = roda BATCH_FILES com cada THROUGHPUT_LEVELS e mostra músicas/min
+THROUGHPUT_LEVELS = (1, 2, 4)
+SEPARATION_SHARE = 0.75       # fração da cota do job para o Demucs (torch); o resto para a análise (BLAS)
+# lote do relatório: precisa passar pelo Demucs e pelo caminho dinâmico (tempo variável), senão não mede o que importa
+BATCH_FILES = ["audio-samples/constant-bpm-song.mp3", "audio-samples/variable-bpm-song.mp3"]
+
+# tempo prior: tempo global das ativações do RNN -> faixa estreita de BPM no DBN
+TEMPO_PRIOR = True
+TEMPO_PRIOR_MARGIN = 0.25     # faixa = tempo / (1 + m) .. tempo * (1 + m)
+TEMPO_PRIOR_AMBIGUOUS = 0.5   # candidato fora da faixa com força >= 50% do principal = oitava ambígua -> faixa completa
+TEMPO_PRIOR_EDGE = 0.03       # BPM a menos de 3% da borda da faixa conta como "encostado"
+TEMPO_PRIOR_MAX_EDGE_FRAC = 0.1  # se >10% dos BPMs encostam na borda, refaz com faixa completa
+DBN_MIN_BPM = 55.0            # faixa completa (padrão do madmom)
+DBN_MAX_BPM = 215.0
+DBN_NUM_TEMPI = 60
+DBN_BENCHMARK_FULL = False    # decodifica também com a faixa completa para medir o speedup real
+                              # (sem isso, só o fallback mede a faixa completa; a razão de estados não é speedup)
+
+# roteamento: tempo constante -> bpm_map de um segmento (pula DBN, MAD, suavização, limitador, agregação)
+# desligado por padrão: os limiares abaixo ainda não foram conferidos em constant-bpm-song / variable-bpm-song
+CONSTANT_TEMPO_ROUTING = False
+CONSTANT_OCTAVE_TOL = 0.04    # bpm do librosa (corrigido de oitava) precisa estar a 4% do tempo do madmom
+ANALYSIS_SR = 22050           # sr da análise barata do librosa
+ANALYSIS_HOP = 256            # hop menor que o padrão (512): tempograma e pulsos mais finos
+CONSTANT_MIN_BEATS = 16
+CONSTANT_WINDOW_BEATS = 8     # bpm local = média de 8 pulsos (dilui a quantização de frame)
+CONSTANT_WINDOW_TOL = 0.02    # janela conta como estável se |bpm/mediana - 1| <= 2%
+CONSTANT_WINDOW_FRAC = 0.95   # fração mínima de janelas estáveis
+CONSTANT_AC_SIZE = 4.0        # janela do tempograma (s); menor que o padrão (8s) para ver variações locais
+CONSTANT_TEMPOGRAM_TOL = 0.03 # ~1 lag em 120 BPM com hop 256
+CONSTANT_TEMPOGRAM_FRAC = 0.9 # fração mínima de frames do tempograma dentro da tolerância
 # -----------------------------------------
 
+# contadores do tempo prior neste processo (quantas vezes ele foi usado ou desligado, e o custo)
+TEMPO_PRIOR_STATS = {
+    "narrowed": 0,        # faixa estreita aceita
+    "no_estimate": 0,     # estimativa falhou -> faixa completa
+    "ambiguous": 0,       # candidato forte fora da faixa -> faixa completa
+    "edge_fallback": 0,   # beats na borda -> decodifica de novo com faixa completa (custo dobrado)
+    "decode_sec": 0.0,    # tempo total de DBN gasto (incluindo decodificações descartadas)
+}
+
 
 def remove_outliers_mad(arr, z_thresh=MAD_Z_THRESH):
     """Remove outliers usando MAD (robusto). Retorna cópia."""
@@ -106,13 +178,248 @@ def aggregate_bpm_map(highres_map, window_sec=AGG_WINDOW_SEC):
     return aggregated
 
 
-def process_bpm_combined(original_file_path):
-    print(f"--- Running Madmom beat tracking on {original_file_path} ({MADMOM_FPS}fps) ---")
+def load_mono(source, sample_rate=None, sr=ANALYSIS_SR):
+    """Áudio mono em `sr`: de um arquivo, ou de um buffer (canais, amostras) já decodificado em `sample_rate`."""
+    if sample_rate is None:
+        return librosa.load(source, sr=sr, mono=True)[0]
+    y = librosa.to_mono(source)
+    return librosa.resample(y, orig_sr=sample_rate, target_sr=sr)
+
+
+def madmom_input(source, sample_rate=None):
+    """Entrada para o RNNBeatProcessor: o caminho do arquivo, ou um Signal mono a partir do buffer."""
+    if sample_rate is None:
+        return source
+    y = np.mean(source, axis=0, dtype=np.float32)
+    if sample_rate != MADMOM_SR:
+        y = librosa.resample(y, orig_sr=sample_rate, target_sr=MADMOM_SR)
+    return Signal(y, sample_rate=MADMOM_SR)
+
+
+def analyze_global_tempo(source, sample_rate=None, hop_length=ANALYSIS_HOP):
+    """
+    Análise global barata (librosa) para o roteamento: pulsos locais e tempo local por frame.
+    Os pulsos vêm dos picos do PLP e não do beat_track, que força um período único
+    (tightness=100) e deixaria os intervalos "constantes" mesmo em músicas com tempo variável.
+    Retorna dict ou None se falhar.
+    """
+    try:
+        y = load_mono(source, sample_rate)
+        sr = ANALYSIS_SR
+        oenv = librosa.onset.onset_strength(y=y, sr=sr, hop_length=hop_length)
+        pulse = librosa.beat.plp(onset_envelope=oenv, sr=sr, hop_length=hop_length,
+                                 tempo_min=DBN_MIN_BPM, tempo_max=DBN_MAX_BPM)
+        local_tempo = librosa.feature.tempo(onset_envelope=oenv, sr=sr, hop_length=hop_length,
+                                            ac_size=CONSTANT_AC_SIZE, aggregate=None)
+    except Exception as e:
+        print(f"WARNING: global tempo analysis failed ({e}).")
+        return None
+    pulse_frames = np.flatnonzero(librosa.util.localmax(pulse))
+    return {
+        "pulse_times": librosa.frames_to_time(pulse_frames, sr=sr, hop_length=hop_length),
+        "local_tempo": np.asarray(local_tempo, dtype=float),
+    }
+
+
+def detect_constant_tempo(analysis):
+    """
+    Decide se a faixa tem tempo constante. As duas checagens precisam passar:
+    - pulsos PLP: bpm em janelas de CONSTANT_WINDOW_BEATS pulsos, todas a <= 2% da mediana
+      (uma deriva de 120 para 126 BPM já falha)
+    - tempograma: tempo local por frame a <= CONSTANT_TEMPOGRAM_TOL da mediana
+    Retorna o bpm (mediana das janelas) ou None.
+    """
+    pulse_times = analysis["pulse_times"]
+    if len(pulse_times) < max(CONSTANT_MIN_BEATS, CONSTANT_WINDOW_BEATS + 1):
+        return None
+
+    n = CONSTANT_WINDOW_BEATS
+    spans = pulse_times[n:] - pulse_times[:-n]
+    window_bpms = 60.0 * n / np.maximum(spans, 1e-6)
+    bpm = float(np.median(window_bpms))
+    window_frac = float(np.mean(np.abs(window_bpms / bpm - 1.0) <= CONSTANT_WINDOW_TOL))
+
+    local = analysis["local_tempo"]
+    local = local[local > 0]
+    if local.size == 0:
+        return None
+    tempogram_frac = float(np.mean(np.abs(local / np.median(local) - 1.0) <= CONSTANT_TEMPOGRAM_TOL))
+
+    print(f"Tempo stability: {window_frac:.0%} pulse windows, {tempogram_frac:.0%} tempogram frames stable")
+    if window_frac < CONSTANT_WINDOW_FRAC or tempogram_frac < CONSTANT_TEMPOGRAM_FRAC:
+        return None
+    return bpm
+
 
-    # 1) Get activations (RNN) and beat_times (DBN)
-    act = RNNBeatProcessor()(original_file_path)
-    proc = DBNBeatTrackingProcessor(fps=MADMOM_FPS)
+def match_octave(bpm, reference, tol=CONSTANT_OCTAVE_TOL):
+    """
+    Corrige a oitava do bpm do librosa (PLP pode pegar metade/dobro) usando o tempo do madmom como referência.
+    Retorna o múltiplo (1, 2, 1/2, 3/2, 2/3) a <= tol da referência, ou None se nenhum bater ou sem referência.
+    """
+    if reference is None:
+        return None
+    for factor in (1.0, 2.0, 0.5, 1.5, 2.0 / 3.0):
+        candidate = bpm * factor
+        if abs(candidate / reference - 1.0) <= tol:
+            return candidate
+    return None
+
+
+def tempo_prior_band(tempo, margin=TEMPO_PRIOR_MARGIN):
+    """Faixa (min_bpm, max_bpm) em torno do tempo estimado, limitada à faixa completa do DBN."""
+    if tempo is None:
+        return DBN_MIN_BPM, DBN_MAX_BPM
+    min_bpm = max(DBN_MIN_BPM, tempo / (1.0 + margin))
+    max_bpm = min(DBN_MAX_BPM, tempo * (1.0 + margin))
+    if min_bpm >= max_bpm:
+        # estimativa fora da faixa suportada: não arrisca
+        return DBN_MIN_BPM, DBN_MAX_BPM
+    return min_bpm, max_bpm
+
+
+def estimate_tempo_prior(act):
+    """
+    Tempo global a partir das ativações do RNN (TempoEstimationProcessor, barato: as ativações já existem).
+    Retorna None se falhar ou se houver um candidato forte fora da faixa (ex: o dobro ou a metade),
+    porque a faixa estreita travaria o DBN numa oitava que pode estar errada.
+    """
+    try:
+        tempi = TempoEstimationProcessor(min_bpm=DBN_MIN_BPM, max_bpm=DBN_MAX_BPM, fps=MADMOM_FPS)(act)
+    except Exception as e:
+        print(f"WARNING: tempo prior failed ({e}).")
+        TEMPO_PRIOR_STATS["no_estimate"] += 1
+        return None
+    if len(tempi) == 0:
+        TEMPO_PRIOR_STATS["no_estimate"] += 1
+        return None
+
+    tempo, strength = float(tempi[0][0]), float(tempi[0][1])
+    min_bpm, max_bpm = tempo_prior_band(tempo)
+    for other, other_strength in tempi[1:]:
+        if other_strength >= TEMPO_PRIOR_AMBIGUOUS * strength and not (min_bpm <= other <= max_bpm):
+            print(f"Tempo prior ambiguous ({tempo:.1f} vs {other:.1f} BPM). Using full DBN range.")
+            TEMPO_PRIOR_STATS["ambiguous"] += 1
+            return None
+    return tempo
+
+
+def dbn_num_states(min_bpm, max_bpm, fps=MADMOM_FPS):
+    """Número de estados do DBN para a faixa (custo do Viterbi cresce com isso)."""
+    st = BeatStateSpace(60.0 * fps / max_bpm, 60.0 * fps / min_bpm, DBN_NUM_TEMPI)
+    return st.num_states
+
+
+def track_beats_dbn(act, min_bpm=DBN_MIN_BPM, max_bpm=DBN_MAX_BPM):
+    """Decodifica beat_times com o DBN numa faixa de BPM. Retorna (beat_times, segundos)."""
+    proc = DBNBeatTrackingProcessor(min_bpm=min_bpm, max_bpm=max_bpm,
+                                    num_tempi=DBN_NUM_TEMPI, fps=MADMOM_FPS)
+    t0 = time.time()
     beat_times = proc(act)
+    return beat_times, time.time() - t0
+
+
+def band_fits(beat_times, min_bpm, max_bpm, edge=TEMPO_PRIOR_EDGE):
+    """True se os beats decodificados cabem na faixa sem encostar nas bordas (sem clipping)."""
+    if len(beat_times) < MIN_BEATS:
+        return False
+    ibis = np.diff(beat_times)
+    ibis[ibis == 0] = 1e-6
+    bpms = 60.0 / ibis
+    near_edge = (bpms < min_bpm * (1.0 + edge)) | (bpms > max_bpm / (1.0 + edge))
+    return near_edge.mean() <= TEMPO_PRIOR_MAX_EDGE_FRAC
+
+
+def tempo_prior_summary():
+    """Uma linha com os contadores do tempo prior neste processo."""
+    s = TEMPO_PRIOR_STATS
+    total = s["narrowed"] + s["no_estimate"] + s["ambiguous"] + s["edge_fallback"]
+    return (f"Tempo prior: narrowed {s['narrowed']}/{total}, ambiguous {s['ambiguous']}, "
+            f"edge fallback {s['edge_fallback']}, no estimate {s['no_estimate']}, "
+            f"DBN total {s['decode_sec']:.2f}s")
+
+
+def decode_beats_with_prior(act, tempo):
+    """
+    DBN com faixa estreita em torno do tempo estimado.
+    Fallback para a faixa completa se não houver estimativa ou se os beats encostarem na borda.
+    O log compara o tempo total de DBN (incluindo a decodificação estreita descartada no fallback)
+    com o tempo da faixa completa sempre que este é medido.
+    """
+    full_states = dbn_num_states(DBN_MIN_BPM, DBN_MAX_BPM)
+    min_bpm, max_bpm = tempo_prior_band(tempo)
+
+    if (min_bpm, max_bpm) == (DBN_MIN_BPM, DBN_MAX_BPM):
+        beat_times, secs = track_beats_dbn(act)
+        TEMPO_PRIOR_STATS["decode_sec"] += secs
+        print(f"DBN full range {DBN_MIN_BPM:.0f}-{DBN_MAX_BPM:.0f} BPM ({full_states} states) in {secs:.2f}s")
+        return beat_times
+
+    beat_times, secs = track_beats_dbn(act, min_bpm, max_bpm)
+    TEMPO_PRIOR_STATS["decode_sec"] += secs
+    narrow_states = dbn_num_states(min_bpm, max_bpm)
+    print(f"DBN band {min_bpm:.1f}-{max_bpm:.1f} BPM ({narrow_states}/{full_states} states) in {secs:.2f}s")
+
+    if not band_fits(beat_times, min_bpm, max_bpm):
+        print("WARNING: beats hit the tempo prior band edge. Falling back to full DBN range.")
+        TEMPO_PRIOR_STATS["edge_fallback"] += 1
+        beat_times, full_secs = track_beats_dbn(act)
+        TEMPO_PRIOR_STATS["decode_sec"] += full_secs
+        total = secs + full_secs
+        print(f"DBN total {total:.2f}s vs full range {full_secs:.2f}s -> "
+              f"{total / max(full_secs, 1e-6):.2f}x slower than without the prior")
+        return beat_times
+
+    TEMPO_PRIOR_STATS["narrowed"] += 1
+    if DBN_BENCHMARK_FULL:
+        _, full_secs = track_beats_dbn(act)
+        print(f"DBN total {secs:.2f}s vs full range {full_secs:.2f}s -> speedup {full_secs / max(secs, 1e-6):.2f}x")
+    else:
+        print("Speedup not measured (DBN_BENCHMARK_FULL = False).")
+    return beat_times
+
+
+def process_bpm_combined(source, sample_rate=None):
+    """
+    source: caminho do arquivo, ou buffer float32 (canais, amostras) do handoff.
+    sample_rate: só para buffer (None = source é arquivo).
+    """
+    label = source if sample_rate is None else f"buffer {tuple(source.shape)} @ {sample_rate}Hz"
+    print(f"--- Running Madmom beat tracking on {label} ({MADMOM_FPS}fps) ---")
+
+    # 0) Cheap global tempo analysis (routing)
+    analysis = None
+    if CONSTANT_TEMPO_ROUTING:
+        analysis_start = time.time()
+        analysis = analyze_global_tempo(source, sample_rate)
+        if analysis is not None:
+            print(f"Global tempo analysis in {time.time() - analysis_start:.2f}s")
+
+    # 0b) Constant tempo candidate (librosa); the octave is confirmed with madmom in 1b)
+    constant_bpm = detect_constant_tempo(analysis) if analysis is not None else None
+
+    # 1) Get activations (RNN) and the global tempo of the activations (madmom)
+    # num_threads=1: com mais, o madmom abre um multiprocessing.Pool (nunca fechado) e cada processo
+    # herda a cota inteira de BLAS do job. A cota do job fica toda com o BLAS.
+    act = RNNBeatProcessor(num_threads=1)(madmom_input(source, sample_rate))
+    tempo = estimate_tempo_prior(act) if (TEMPO_PRIOR or constant_bpm is not None) else None
+    if tempo is not None:
+        print(f"Tempo prior: {tempo:.1f} BPM")
+
+    # 1b) Constant tempo: single segment, skip DBN and the rest of the dynamic path.
+    # librosa gives the precise bpm, madmom decides the octave (None = ambiguous -> dynamic path)
+    if constant_bpm is not None:
+        constant_bpm = match_octave(constant_bpm, tempo)
+        if constant_bpm is not None:
+            print("Constant tempo detected. Skipping dynamic path.")
+            return [{"time_sec": 0.0, "bpm": round(float(constant_bpm), 2)}]
+        print("Constant tempo octave not confirmed by madmom. Using dynamic path.")
+    if not TEMPO_PRIOR:
+        tempo = None
+
+    # 1c) beat_times (DBN, narrowed by the tempo of the activations)
+    beat_times = decode_beats_with_prior(act, tempo)
+    if TEMPO_PRIOR:
+        print(tempo_prior_summary())
 
     if len(beat_times) < MIN_BEATS:
         print("ERROR: not enough beats found by madmom.")
@@ -148,6 +455,243 @@ def process_bpm_combined(original_file_path):
     return result
 
 
+def handoff_dir(nbytes):
+    """
+    Diretório com espaço livre para `nbytes` de buffers: HANDOFF_DIR, senão o temp do sistema.
+    /dev/shm pode ser pequeno (64 MB no docker) e um tmpfs cheio não gera exceção no memmap: o processo
+    morre com SIGBUS na escrita e os buffers ficam para trás.
+    """
+    needed = nbytes * (1.0 + HANDOFF_HEADROOM)
+    for folder in dict.fromkeys((HANDOFF_DIR, tempfile.gettempdir())):
+        if shutil.disk_usage(folder).free >= needed:
+            return folder
+        print(f"WARNING: not enough free space in {folder} for {nbytes / 1e6:.0f} MB of buffers.")
+    raise RuntimeError(f"No handoff dir with {nbytes / 1e6:.0f} MB free.")
+
+
+def publish_buffer(descriptor, name, tensor):
+    """Escreve um tensor (canais, amostras) num buffer float32 mapeado em memória e registra no descritor."""
+    data = tensor.detach().cpu().numpy().astype(np.float32, copy=False)
+    path = os.path.join(descriptor["dir"], f"{descriptor['job_id']}-{name}.f32")
+    descriptor["buffers"][name] = {"path": path, "shape": list(data.shape), "dtype": "float32"}
+    with open(path, "wb") as f:
+        if hasattr(os, "posix_fallocate"):
+            # reserva o espaço agora: falta de espaço vira OSError aqui, e não SIGBUS na escrita
+            os.posix_fallocate(f.fileno(), 0, data.nbytes)
+        else:
+            f.truncate(data.nbytes)
+    buf = np.memmap(path, dtype=np.float32, mode="r+", shape=data.shape)
+    buf[:] = data
+    buf.flush()
+    del buf
+
+
+def attach_buffer(descriptor, name):
+    """Abre um buffer do descritor sem cópia nem desserialização (memmap somente leitura)."""
+    info = descriptor["buffers"][name]
+    return np.memmap(info["path"], dtype=info["dtype"], mode="r", shape=tuple(info["shape"]))
+
+
+def release_handoff(descriptor):
+    """Remove os buffers do job. Chamar no fim do job (sucesso ou erro)."""
+    for info in descriptor["buffers"].values():
+        try:
+            os.remove(info["path"])
+        except FileNotFoundError:
+            pass
+
+
+def separate_to_handoff(file_path, job_id, stems=HANDOFF_STEMS, skip_separation=SKIP_SEPARATION):
+    """
+    Roda o Demucs (mesmo pré/pós-processamento do demucs.separate) e escreve os stems em buffers float32
+    mapeados em memória, ao invés de WAVs em STEMS_FOLDER. Publica `stems` (None = todos os do modelo)
+    mais o ANALYSIS_SOURCE ("mix" ou um stem). Com skip_separation, o Demucs não roda e só a mix é publicada.
+    Retorna o descritor (pequeno, picklável).
+    """
+    if skip_separation:
+        if ANALYSIS_SOURCE != "mix":
+            raise ValueError(f"SKIP_SEPARATION needs ANALYSIS_SOURCE = 'mix' (got {ANALYSIS_SOURCE!r}).")
+        print("SKIP_SEPARATION = True: Demucs not run, publishing only the mix.")
+        wav = AudioFile(file_path).read(streams=0, samplerate=MADMOM_SR, channels=2)
+        names, buffers, samplerate = ["mix"], {"mix": wav}, MADMOM_SR
+    else:
+        model = get_model(DEMUCS_MODEL)
+        model.eval()
+        samplerate = model.samplerate
+        stem_names = list(model.sources) if stems is None else list(stems)
+        names = list(dict.fromkeys(stem_names + [ANALYSIS_SOURCE]))
+        unknown = set(names) - set(model.sources) - {"mix"}
+        if unknown:
+            raise ValueError(f"Unknown stems for {DEMUCS_MODEL}: {sorted(unknown)}")
+
+        wav = AudioFile(file_path).read(streams=0, samplerate=samplerate, channels=model.audio_channels)
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+        ref = wav.mean(0)
+        wav = (wav - ref.mean()) / ref.std()
+        with torch.no_grad():
+            sources = apply_model(model, wav[None], device=device, shifts=1, split=True, overlap=0.25, progress=True)[0]
+        sources = sources * ref.std() + ref.mean()
+        wav = wav * ref.std() + ref.mean()
+        buffers = {name: source for name, source in zip(model.sources, sources) if name in names}
+        if "mix" in names:
+            buffers["mix"] = wav
+
+    nbytes = sum(t.numel() * 4 for t in buffers.values())  # float32
+    descriptor = {"job_id": job_id, "samplerate": samplerate, "separated": not skip_separation,
+                  "dir": handoff_dir(nbytes), "buffers": {}}
+    try:
+        for name in names:
+            publish_buffer(descriptor, name, buffers[name])
+    except Exception:
+        release_handoff(descriptor)
+        raise
+    return descriptor
+
+
+def analyze_handoff(descriptor, source_name=ANALYSIS_SOURCE):
+    """Worker de análise: anexa o buffer do descritor e roda o extrator de BPM."""
+    audio = attach_buffer(descriptor, source_name)
+    return process_bpm_combined(audio, sample_rate=descriptor["samplerate"])
+
+
+def plan_thread_budget(jobs, cores=NODE_CORES):
+    """
+    Divide os cores do nó entre os jobs simultâneos e, dentro da cota de cada job, entre as etapas.
+    As etapas rodam em pipeline (a análise de uma música roda enquanto a próxima é separada),
+    então separação + análise somam a cota do job: SEPARATION_SHARE para o Demucs, o resto para a análise.
+    """
+    jobs = max(1, int(jobs))
+    per_job = max(1, cores // jobs)
+    if per_job == 1:
+        return {"jobs": jobs, "per_job": 1, "separation": 1, "analysis": 1}
+    separation = min(per_job - 1, max(1, round(per_job * SEPARATION_SHARE)))
+    return {"jobs": jobs, "per_job": per_job, "separation": separation, "analysis": per_job - separation}
+
+
+def thread_env(num_threads):
+    """Variáveis de ambiente de BLAS/OpenMP. Só valem para processos que ainda vão importar numpy/torch."""
+    n = str(num_threads)
+    return {
+        "OMP_NUM_THREADS": n,
+        "MKL_NUM_THREADS": n,
+        "OPENBLAS_NUM_THREADS": n,
+        "NUMEXPR_NUM_THREADS": n,
+        "VECLIB_MAXIMUM_THREADS": n,
+    }
+
+
+def apply_thread_limits(num_threads):
+    """Limita torch (intra-op), BLAS/OpenMP e o ambiente herdado por subprocessos. Usado como initializer dos workers."""
+    os.environ.update(thread_env(num_threads))
+    torch.set_num_threads(num_threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # só pode ser definido antes do primeiro trabalho paralelo do processo
+    threadpool_limits(limits=num_threads)
+
+
+def _worker_pid(delay):
+    time.sleep(delay)
+    return os.getpid()
+
+
+def limited_pool(max_workers, num_threads):
+    """
+    Pool de processos com `num_threads` threads por worker, com todos os workers já de pé.
+    spawn (e não fork, o padrão no linux): o worker importa numpy/torch do zero já com as variáveis
+    de ambiente do limite; com fork ele herdaria os pools de BLAS já abertos pelo processo pai.
+    Os workers sobem aqui (e não no primeiro job) para herdarem o ambiente deste limite e para o custo
+    de startup/imports ficar fora das medições.
+    """
+    os.environ.update(thread_env(num_threads))
+    pool = ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context("spawn"),
+                               initializer=apply_thread_limits, initargs=(num_threads,))
+    pids = set()
+    while len(pids) < max_workers:
+        pids.update(pool.map(_worker_pid, [0.05] * max_workers))
+    return pool
+
+
+def separate_job(file_path):
+    """Worker de separação: Demucs -> buffers. Retorna o descritor."""
+    start = time.time()
+    job_id = f"{os.path.splitext(os.path.basename(file_path))[0]}-{uuid.uuid4().hex[:8]}"
+    descriptor = separate_to_handoff(file_path, job_id)
+    stage = "Demucs" if descriptor["separated"] else "Decode (Demucs skipped)"
+    print(f"{stage} finished in {time.time() - start:.2f}s ({file_path}, buffers: {', '.join(descriptor['buffers'])})")
+    return descriptor
+
+
+def run_batch(files, jobs):
+    """
+    Roda `files` com `jobs` jobs simultâneos. Dois pools vivem durante o lote inteiro, sem processo novo
+    por música: `jobs` workers de separação (torch) e `jobs` workers de análise (BLAS), cada um na sua cota.
+    Só o descritor passa entre os processos; os buffers de cada música são apagados quando a análise termina.
+    Retorna (bpm_maps na ordem de `files`, segundos gastos subindo os pools).
+    """
+    budget = plan_thread_budget(jobs)
+    startup_start = time.time()
+    with limited_pool(budget["jobs"], budget["separation"]) as sep_pool, \
+            limited_pool(budget["jobs"], budget["analysis"]) as ana_pool:
+        startup = time.time() - startup_start
+        sep_futures = {sep_pool.submit(separate_job, f): i for i, f in enumerate(files)}
+        ana_futures = {}
+        results = [None] * len(files)
+        first_error = None
+        # erros não interrompem o laço: todo descritor que chegou é analisado e/ou liberado
+        for fut in as_completed(sep_futures):
+            try:
+                descriptor = fut.result()
+            except Exception as e:
+                first_error = first_error or e
+                continue
+            ana_futures[ana_pool.submit(analyze_handoff, descriptor, ANALYSIS_SOURCE)] = (sep_futures[fut], descriptor)
+        for fut in as_completed(ana_futures):
+            i, descriptor = ana_futures[fut]
+            try:
+                results[i] = fut.result()
+            except Exception as e:
+                first_error = first_error or e
+            finally:
+                release_handoff(descriptor)
+    if first_error is not None:
+        raise first_error
+    return results, startup
+
+
+def throughput_report(files=BATCH_FILES, levels=THROUGHPUT_LEVELS):
+    """
+    Throughput x concorrência: mesmo lote para cada nível de jobs por nó. Retorna as linhas da tabela.
+    O tempo de subir os pools (startup + imports) aparece à parte e não entra em músicas/min.
+    """
+    if SKIP_SEPARATION or CONSTANT_TEMPO_ROUTING:
+        print("WARNING: SKIP_SEPARATION / CONSTANT_TEMPO_ROUTING on: the report will not measure Demucs / the dynamic path.")
+    # lote fixo com pelo menos max(levels) músicas, para todos os níveis ficarem ocupados
+    batch = list(files) * max(1, -(-max(levels) // len(files)))
+    rows = []
+    for jobs in levels:
+        budget = plan_thread_budget(jobs)
+        start = time.time()
+        _, startup = run_batch(batch, jobs)
+        elapsed = time.time() - start - startup
+        rows.append({"jobs": jobs, "threads_per_job": budget["per_job"], "separation_threads": budget["separation"],
+                     "analysis_threads": budget["analysis"], "tracks": len(batch),
+                     "startup_sec": round(startup, 2), "elapsed_sec": round(elapsed, 2),
+                     "tracks_per_min": round(len(batch) * 60.0 / elapsed, 2)})
+
+    print(f"\n--- Throughput vs concurrency ({NODE_CORES} cores) ---")
+    print(f"{'jobs':>4} {'sep+ana threads':>15} {'tracks':>6} {'startup (s)':>11} {'time (s)':>9} {'tracks/min':>10}")
+    for r in rows:
+        threads = f"{r['separation_threads']}+{r['analysis_threads']}"
+        print(f"{r['jobs']:>4} {threads:>15} {r['tracks']:>6} {r['startup_sec']:>11.2f} "
+              f"{r['elapsed_sec']:>9.2f} {r['tracks_per_min']:>10.2f}")
+    best = max(rows, key=lambda r: r["tracks_per_min"])
+    print(f"Best JOBS_PER_NODE: {best['jobs']}")
+    print("---------------------------")
+    return rows
+
+
 def main():
     t0 = time.time()
     print("--- 1. Environment check ---")
@@ -158,17 +702,34 @@ def main():
         print(f"ERROR: file not found: {FILE_NAME}")
         return
 
-    # keep Demucs step (you had it before); optional if not needed
-    print("--- 2. Running Demucs (optional) ---")
-    warnings.filterwarnings("ignore")
-    demucs_start = time.time()
-    demucs.separate.main(["-n", DEMUCS_MODEL, FILE_NAME])
-    demucs_end = time.time()
-    print(f"Demucs finished in {demucs_end - demucs_start:.2f}s")
-    print("------------------------------------\n")
-
-    # Run combined BPM extractor on the ORIGINAL mix
-    bpm_map = process_bpm_combined(FILE_NAME)
+    if THROUGHPUT_REPORT:
+        warnings.filterwarnings("ignore")
+        throughput_report()
+        return
+
+    budget = plan_thread_budget(JOBS_PER_NODE)
+    print(f"Thread budget: {budget['per_job']} of {NODE_CORES} cores ({JOBS_PER_NODE} jobs per node, "
+          f"{budget['separation']} separation + {budget['analysis']} analysis)\n")
+
+    if STEM_HANDOFF == "wav":
+        apply_thread_limits(budget["per_job"])
+
+        # keep Demucs step (you had it before); optional if not needed
+        print("--- 2. Running Demucs (optional) ---")
+        warnings.filterwarnings("ignore")
+        demucs_start = time.time()
+        demucs.separate.main(["-n", DEMUCS_MODEL, FILE_NAME])
+        demucs_end = time.time()
+        print(f"Demucs finished in {demucs_end - demucs_start:.2f}s")
+        print("------------------------------------\n")
+
+        # Run combined BPM extractor on the ORIGINAL mix
+        bpm_map = process_bpm_combined(FILE_NAME)
+    else:
+        print(f"--- 2. Running Demucs -> memmap buffers in {HANDOFF_DIR} ---")
+        warnings.filterwarnings("ignore")
+        (bpm_map,), _ = run_batch([FILE_NAME], JOBS_PER_NODE)
+        print("------------------------------------\n")
 
     print("\n--- Final Result (JSON) ---")
     print(json.dumps({"bpm_map": bpm_map}, indent=2))